@@ -1,15 +1,11 @@
 from django.contrib import admin
-from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
 
 from .models import (
-    Tag, Ingredient, Recipe, Subscription, Favorite, ShoppingCart
+    Tag, Ingredient, Recipe, Subscription, Favorite, ShoppingCart, User
 )
 
 
-User = get_user_model()
-
-
 class CustomUserAdmin(UserAdmin):
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_staff')
     list_filter = ('is_staff', 'is_superuser', 'is_active')
@@ -37,21 +33,30 @@ class RecipeAdmin(admin.ModelAdmin):
     search_fields = ('name', 'author__username')
     list_filter = ('tags', 'pub_date')
     list_display_links = ('name',)
+    list_select_related = ('author',)
+    raw_id_fields = ('author',)
+    show_full_result_count = False
 
 
 class SubscriptionAdmin(admin.ModelAdmin):
     list_display = ('subscriber', 'author', 'created_at')
     search_fields = ('subscriber__username', 'author__username')
+    list_select_related = ('subscriber', 'author')
+    show_full_result_count = False
 
 
 class FavoriteAdmin(admin.ModelAdmin):
     list_display = ('user', 'recipe', 'created_at')
     search_fields = ('user__username', 'recipe__name')
+    list_select_related = ('user', 'recipe')
+    show_full_result_count = False
 
 
 class ShoppingCartAdmin(admin.ModelAdmin):
     list_display = ('user', 'recipe', 'created_at')
     search_fields = ('user__username', 'recipe__name')
+    list_select_related = ('user', 'recipe')
+    show_full_result_count = False
 
 
 admin.site.register(User, CustomUserAdmin)
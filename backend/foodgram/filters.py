@@ -1,24 +1,36 @@
 import django_filters
+from django.db.models import Exists, OuterRef
 from django_filters.rest_framework import FilterSet
-from django_filters.rest_framework.filters import (
-    CharFilter,
-)
-from rest_framework.filters import SearchFilter
+from rest_framework.filters import BaseFilterBackend
 
-from .models import Recipe, Ingredient
+from .models import Recipe, Tag
 
 
-class IngredientFilter(SearchFilter):
-    name = CharFilter(lookup_expr='istartswith')
+class IngredientFilter(BaseFilterBackend):
+    """
+    Поиск продуктов по началу названия: ?name=<строка>.
 
-    class Meta:
-        model = Ingredient
-        fields = ('name', )
+    Вся строка ищется как один префикс; на PostgreSQL запрос
+    UPPER(name) LIKE 'Q%' использует индекс ingredient_name_trgm.
+    """
+
+    search_param = 'name'
+
+    def filter_queryset(self, request, queryset, view):
+        name = request.query_params.get(self.search_param, '').strip()
+        if not name:
+            return queryset
+        return queryset.filter(name__istartswith=name)
 
 
 class RecipeFilterSet(FilterSet):
     author = django_filters.NumberFilter(field_name='author__id')
-    tags = django_filters.AllValuesMultipleFilter(field_name='tags__slug')
+    tags = django_filters.ModelMultipleChoiceFilter(
+        field_name='tags__slug',
+        to_field_name='slug',
+        queryset=Tag.objects.all(),
+        method='filter_tags',
+    )
     is_favorited = django_filters.BooleanFilter(method='filter_is_favorited')
     is_in_shopping_cart = django_filters.BooleanFilter(
         method='filter_is_in_shopping_cart'
@@ -28,14 +40,27 @@ class RecipeFilterSet(FilterSet):
         model = Recipe
         fields = ['author', 'tags', 'is_favorited', 'is_in_shopping_cart']
 
+    def filter_tags(self, queryset, name, value):
+        if not value:
+            return queryset
+        return queryset.filter(
+            Exists(
+                Recipe.tags.through.objects.filter(
+                    recipe=OuterRef('pk'), tag__in=value
+                )
+            )
+        )
+
     def filter_is_favorited(self, queryset, name, value):
         user = self.request.user
         if value and user.is_authenticated:
-            return queryset.filter(favorites__user=user)
+            return queryset.with_user_flags(user).filter(is_favorited=True)
         return queryset
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
         user = self.request.user
         if value and user.is_authenticated:
-            return queryset.filter(shoppingcarts__user=user)
+            return queryset.with_user_flags(user).filter(
+                is_in_shopping_cart=True
+            )
         return queryset
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+INDEX_NAME = 'ingredient_name_trgm'
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    Создает GIN-индекс по триграммам для поиска продуктов по названию.
+
+    Django строит istartswith как UPPER(name) LIKE UPPER(%s), поэтому
+    индекс строится по выражению UPPER(name). На других СУБД пропускается.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {INDEX_NAME} '
+        'ON foodgram_ingredient USING gin (UPPER(name) gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodgram', '0003_user_recipe_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
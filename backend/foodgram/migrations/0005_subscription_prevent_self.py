@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-15 21:28
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodgram', '0004_ingredient_name_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.CheckConstraint(check=models.Q(('subscriber', django.db.models.expressions.F('author')), _negated=True), name='prevent_self_subscription'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-15 21:30
+
+from django.db import migrations
+import foodgram.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodgram', '0005_subscription_prevent_self'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', foodgram.models.UserManager()),
+            ],
+        ),
+    ]
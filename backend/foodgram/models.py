@@ -1,15 +1,41 @@
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import UserManager as BaseUserManager
 from django.core.validators import MinValueValidator
-from django.db import models, IntegrityError
-from django.db.models.constraints import UniqueConstraint
+from django.db import models, transaction, IntegrityError
+from django.db.models import (
+    BooleanField, Count, Exists, F, OuterRef, Q, Sum, Value
+)
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.db.models.constraints import CheckConstraint, UniqueConstraint
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.urls import reverse
-from random import choices
+from functools import lru_cache
+from operator import itemgetter
+from os import urandom
 from string import ascii_letters, digits
 
 from .validators import validate_username
 
+get_id_and_amount = itemgetter('id', 'amount')
+
+SHORT_CODE_CHARS = ascii_letters + digits
+SHORT_CODE_LENGTH = 6
+SHORT_CODE_GENERATION_ERROR = 'Превышено количество попыток создания ссылки.'
+SHORT_CODE_CACHE_KEY = 'recipe_short_code:{}'
+SHORT_CODE_CACHE_TIMEOUT = 60 * 60
+REFERENCE_VERSION_KEY = 'reference_version:{}'
+REFERENCE_VERSION_TIMEOUT = 60 * 5
+SHOPPING_CART_VERSION_KEY = 'shopping_cart_version:{}'
+SHOPPING_CART_CACHE_KEY = 'shopping_cart:{}:{}'
+SHOPPING_CART_CACHE_TIMEOUT = 60 * 60
+# Таблица для bytes.translate: каждому байту сопоставлен символ алфавита
+SHORT_CODE_TABLE = bytes(
+    ord(SHORT_CODE_CHARS[byte % len(SHORT_CODE_CHARS)]) for byte in range(256)
+)
+
 
 class RecipeValidationError(Exception):
     """Кастомное исключение для ошибок валидации рецепта."""
@@ -21,6 +47,32 @@ class DuplicateRecipeError(Exception):
     pass
 
 
+class UserQuerySet(models.QuerySet):
+    """QuerySet пользователей с флагом подписки текущего пользователя."""
+
+    def with_subscription_flag(self, viewer):
+        """Аннотирует пользователей флагом подписки viewer на них."""
+        if not viewer.is_authenticated:
+            return self.annotate(
+                is_subscribed_ann=Value(False, output_field=BooleanField())
+            )
+        return self.annotate(
+            is_subscribed_ann=Exists(
+                Subscription.objects.filter(
+                    subscriber=viewer, author=OuterRef('pk')
+                )
+            )
+        )
+
+    def with_recipes_count(self):
+        """Аннотирует пользователей количеством их рецептов."""
+        return self.annotate(recipes_count=Count('recipes'))
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    """Менеджер пользователей с методами UserQuerySet."""
+
+
 class User(AbstractUser):
     """Модель пользователя с кастомными полями."""
 
@@ -53,6 +105,8 @@ class User(AbstractUser):
         blank=True,
     )
 
+    objects = UserManager()
+
     class Meta(AbstractUser.Meta):
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
@@ -63,15 +117,12 @@ class User(AbstractUser):
 
     @property
     def is_subscribed(self):
-        """Проверка, подписан ли текущий пользователь на этого пользователя."""
-        if hasattr(self, '_is_subscribed'):
-            return self._is_subscribed
-        return False
+        """
+        Проверка, подписан ли текущий пользователь на этого пользователя.
 
-    @is_subscribed.setter
-    def is_subscribed(self, value):
-        """Устанавливает флаг подписки."""
-        self._is_subscribed = value
+        Значение берётся из аннотации UserQuerySet.with_subscription_flag.
+        """
+        return getattr(self, 'is_subscribed_ann', False)
 
 
 class Subscription(models.Model):
@@ -103,23 +154,17 @@ class Subscription(models.Model):
                 fields=('subscriber', 'author'),
                 name='unique_user_subscription'
             ),
+            CheckConstraint(
+                check=~Q(subscriber=F('author')),
+                name='prevent_self_subscription'
+            ),
         )
 
     def clean(self):
         """Валидация подписки."""
-        if self.subscriber == self.author:
+        if self.subscriber_id == self.author_id:
             raise ValidationError('Нельзя подписаться на собственный аккаунт')
 
-    def save(self, *args, **kwargs):
-        """Сохраняет подписку с валидацией."""
-        try:
-            self.full_clean()
-            super().save(*args, **kwargs)
-        except ValidationError as e:
-            if 'subscriber' in e.message_dict and 'author' in e.message_dict:
-                raise IntegrityError("Subscription already exists")
-            raise e
-
     def __str__(self) -> str:
         return f'{self.subscriber} -> {self.author}'
 
@@ -189,11 +234,86 @@ class Ingredient(models.Model):
         return f'{self.name}, {self.measurement_unit}'
 
 
+@lru_cache(maxsize=None)
+def get_reference_map(model):
+    """
+    Возвращает справочник (теги или продукты) в виде словаря id -> объект.
+
+    Справочники почти не меняются, поэтому хранятся в памяти процесса.
+    Сигналы сбрасывают карту только при изменениях в этом же процессе;
+    записи, добавленные извне (loaddata, shell), подхватывает
+    load_reference_map.
+    """
+    return model.objects.in_bulk()
+
+
+def load_reference_map(model, ids):
+    """
+    Возвращает карту справочника, перечитанную, если в ней нет ids из БД.
+
+    Если все ids уже в памяти, запросов нет; иначе один запрос проверяет,
+    появились ли недостающие записи, и только тогда карта загружается
+    заново. Неизвестные ids не вызывают полной перезагрузки справочника.
+    """
+    reference_map = get_reference_map(model)
+    missing_ids = set(ids) - reference_map.keys()
+    if missing_ids and model.objects.filter(pk__in=missing_ids).exists():
+        get_reference_map.cache_clear()
+        reference_map = get_reference_map(model)
+    return reference_map
+
+
+def get_reference_version(model):
+    """
+    Возвращает версию справочника для кэша ответов и ETag.
+
+    Версия хранится в кэше Django (без настройки CACHES это память
+    процесса). Сигналы сбрасывают её при изменениях в этом же процессе,
+    а изменения извне (loaddata, shell) становятся видны не позже чем
+    через REFERENCE_VERSION_TIMEOUT секунд, когда версия истекает.
+    """
+    return cache.get_or_set(
+        REFERENCE_VERSION_KEY.format(model._meta.label_lower),
+        lambda: urandom(8).hex(),
+        REFERENCE_VERSION_TIMEOUT,
+    )
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def reset_reference_map(sender, **kwargs):
+    """Сбрасывает кэш справочников после изменения тегов или продуктов."""
+    get_reference_map.cache_clear()
+    version_key = REFERENCE_VERSION_KEY.format(sender._meta.label_lower)
+    transaction.on_commit(lambda: cache.delete(version_key))
+
+
+class RecipeQuerySet(models.QuerySet):
+    """QuerySet рецептов с пакетными флагами пользователя."""
+
+    def with_user_flags(self, user):
+        """Аннотирует рецепты флагами избранного и корзины пользователя."""
+        if not user.is_authenticated:
+            return self.annotate(
+                is_favorited=Value(False, output_field=BooleanField()),
+                is_in_shopping_cart=Value(False, output_field=BooleanField()),
+            )
+        return self.annotate(
+            is_favorited=Exists(
+                Favorite.objects.filter(user=user, recipe=OuterRef('pk'))
+            ),
+            is_in_shopping_cart=Exists(
+                ShoppingCart.objects.filter(user=user, recipe=OuterRef('pk'))
+            ),
+        )
+
+
 class Recipe(models.Model):
     """Основная модель рецептов."""
 
     MAX_GENERATION_ATTEMPTS = 30
-    SHORT_CODE_CHARS = ascii_letters + digits
 
     name = models.CharField(
         verbose_name='Название',
@@ -241,26 +361,29 @@ class Recipe(models.Model):
         auto_now_add=True
     )
 
+    objects = RecipeQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         default_related_name = 'recipes'
         ordering = ('-pub_date',)
         indexes = [
+            # Остаётся B-tree: BRIN не отдаёт строки в порядке индекса,
+            # а списки строятся как ORDER BY pub_date DESC LIMIT n.
             models.Index(fields=['pub_date']),
             models.Index(fields=['author', 'pub_date']),
         ]
 
     @staticmethod
     def generate_short():
-        """Создает уникальный короткий код для URL."""
-        attempts = 0
-        while attempts < Recipe.MAX_GENERATION_ATTEMPTS:
-            code = ''.join(choices(Recipe.SHORT_CODE_CHARS, k=6))
-            if not Recipe.objects.filter(short_url_code=code).exists():
-                return code
-            attempts += 1
-        raise RuntimeError('Превышено количество попыток создания ссылки.')
+        """
+        Создает короткий код для URL.
+
+        Уникальность не проверяется запросом к БД: коллизию обнаруживает
+        уникальный индекс при сохранении, и тогда код генерируется заново.
+        """
+        return urandom(SHORT_CODE_LENGTH).translate(SHORT_CODE_TABLE).decode()
 
     def clean(self):
         """Валидация рецепта перед сохранением."""
@@ -277,7 +400,11 @@ class Recipe(models.Model):
             })
 
     def validate_ingredients(self, ingredients_data):
-        """Валидирует данные ингредиентов."""
+        """
+        Валидирует данные ингредиентов.
+
+        Возвращает словарь id продукта -> количество.
+        """
         if not ingredients_data:
             raise RecipeValidationError(
                 'Список ингредиентов не может быть пустым'
@@ -286,66 +413,109 @@ class Recipe(models.Model):
         if not isinstance(ingredients_data, list):
             raise RecipeValidationError("Ingredients data must be a list")
 
-        ingredient_ids = []
-        for ingredient in ingredients_data:
-            # Проверяем структуру данных
-            if not isinstance(ingredient, dict):
-                raise RecipeValidationError(
-                    "Each ingredient must be a dictionary"
-                )
-
-            ingredient_id = ingredient.get('id')
-            amount = ingredient.get('amount')
-
-            # Проверяем обязательные поля
-            if not ingredient_id:
-                raise RecipeValidationError("Ingredient ID is required")
-
-            if amount is None:
-                raise RecipeValidationError("Ingredient amount is required")
-
-            # Проверяем тип и значение amount
-            try:
-                amount = int(amount)
-            except (TypeError, ValueError):
-                raise RecipeValidationError("Amount must be a valid integer")
+        try:
+            pairs = [get_id_and_amount(item) for item in ingredients_data]
+        except (KeyError, TypeError):
+            raise RecipeValidationError(
+                "Each ingredient must be a dictionary with id and amount"
+            )
 
-            if amount < 1:
-                raise RecipeValidationError(
-                    'Количество ингредиента должно быть положительным числом'
-                )
+        try:
+            ingredient_ids = [int(ingredient_id) for ingredient_id, _ in pairs]
+            amounts = [int(amount) for _, amount in pairs]
+        except (TypeError, ValueError):
+            raise RecipeValidationError(
+                "Ingredient ID and amount must be valid integers"
+            )
 
-            ingredient_ids.append(ingredient_id)
+        if min(amounts) < 1:
+            raise RecipeValidationError(
+                'Количество ингредиента должно быть положительным числом'
+            )
 
         # Проверяем дубликаты
-        if len(ingredient_ids) != len(set(ingredient_ids)):
+        unique_ids = set(ingredient_ids)
+        if len(ingredient_ids) != len(unique_ids):
             raise RecipeValidationError('Обнаружены повторяющиеся ингредиенты')
 
+        # Проверяем существование всех ингредиентов за одно обращение
+        missing_ids = (
+            unique_ids - load_reference_map(Ingredient, unique_ids).keys()
+        )
+        if missing_ids:
+            raise RecipeValidationError(
+                f'Не найдены ингредиенты с ID: {missing_ids}'
+            )
+
+        return dict(zip(ingredient_ids, amounts))
+
     def validate_tags(self, tags_data):
         """Валидирует данные тегов."""
         if not tags_data:
             raise RecipeValidationError('Список тегов не может быть пустым')
 
-        if len(tags_data) != len(set(tags_data)):
+        unique_ids = set(tags_data)
+        if len(tags_data) != len(unique_ids):
             raise RecipeValidationError('Обнаружены повторяющиеся теги')
 
+        missing_ids = unique_ids - load_reference_map(Tag, unique_ids).keys()
+        if missing_ids:
+            raise RecipeValidationError(f'Не найдены теги с ID: {missing_ids}')
+
     def add_ingredients(self, ingredients_data):
-        """Добавляет ингредиенты к рецепту."""
-        self.validate_ingredients(ingredients_data)
-
-        recipe_ingredients = []
-        for ingredient_data in ingredients_data:
-            recipe_ingredients.append(
-                RecipeIngredient(
-                    recipe=self,
-                    ingredient_id=ingredient_data['id'],
-                    amount=ingredient_data['amount']
-                )
+        """Валидирует и записывает ингредиенты рецепта, заменяя прежние."""
+        self.set_ingredient_amounts(
+            self.validate_ingredients(ingredients_data)
+        )
+
+    def set_ingredient_amounts(self, amounts):
+        """
+        Приводит ингредиенты рецепта к словарю id продукта -> количество.
+
+        Повторный вызов идемпотентен: создаются только новые строки,
+        обновляются только изменившиеся количества, а продукты,
+        которых нет в новых данных, удаляются одним запросом.
+        """
+        existing = {
+            recipe_ingredient.ingredient_id: recipe_ingredient
+            for recipe_ingredient in self.recipe_ingredients.order_by()
+        }
+
+        stale_ids = existing.keys() - amounts.keys()
+        if stale_ids:
+            self.recipe_ingredients.filter(
+                ingredient_id__in=stale_ids
+            ).delete()
+
+        changed = []
+        for ingredient_id, recipe_ingredient in existing.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and recipe_ingredient.amount != amount:
+                recipe_ingredient.amount = amount
+                changed.append(recipe_ingredient)
+        if changed:
+            RecipeIngredient.objects.bulk_update(
+                changed, ('amount',), batch_size=500
+            )
+
+        created = [
+            RecipeIngredient(
+                recipe=self, ingredient_id=ingredient_id, amount=amount
+            )
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in existing
+        ]
+        if created:
+            RecipeIngredient.objects.bulk_create(created, batch_size=500)
+
+        # bulk-операции не шлют сигналы, поэтому кэш корзин сбрасывается явно
+        if stale_ids or changed or created:
+            ShoppingCart.reset_cached_summaries(
+                ShoppingCart.objects.filter(recipe=self)
             )
-        RecipeIngredient.objects.bulk_create(recipe_ingredients)
 
     def add_tags(self, tags_data):
-        """Добавляет теги к рецепту."""
+        """Валидирует и записывает теги рецепта, заменяя прежние."""
         self.validate_tags(tags_data)
         self.tags.set(tags_data)
 
@@ -353,12 +523,16 @@ class Recipe(models.Model):
         """Проверяет, добавлен ли рецепт в избранное пользователем."""
         if not user.is_authenticated:
             return False
+        if hasattr(self, 'is_favorited'):
+            return self.is_favorited
         return self.favorites.filter(user=user).exists()
 
     def is_in_shopping_cart_of(self, user):
         """Проверяет, добавлен ли рецепт в корзину пользователем."""
         if not user.is_authenticated:
             return False
+        if hasattr(self, 'is_in_shopping_cart'):
+            return self.is_in_shopping_cart
         return self.shoppingcarts.filter(user=user).exists()
 
     def save(self, *args, **kwargs):
@@ -366,31 +540,43 @@ class Recipe(models.Model):
         if not self.short_url_code:
             self.short_url_code = self.generate_short()
 
-        attempts = 0
-        while attempts < self.MAX_GENERATION_ATTEMPTS:
+        # Уникальность короткого кода проверяет БД, а не full_clean
+        self.full_clean(validate_unique=False)
+
+        for _ in range(self.MAX_GENERATION_ATTEMPTS):
             try:
-                # Валидация и сохранение
-                self.full_clean()
-                super().save(*args, **kwargs)
-                return
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
             except IntegrityError as e:
-                if 'short_url_code' in str(e):
-                    attempts += 1
-                    self.short_url_code = self.generate_short()
-                else:
-                    raise e
-            except ValidationError as e:
-                raise e
+                if 'short_url_code' not in str(e):
+                    raise
+                self.short_url_code = self.generate_short()
 
-        raise RuntimeError('Превышено количество попыток создания ссылки.')
+        raise RuntimeError(SHORT_CODE_GENERATION_ERROR)
 
     @classmethod
-    def get_by_short_code(cls, code):
-        """Безопасное получение рецепта по короткому коду."""
-        try:
-            return cls.objects.get(short_url_code=code)
-        except cls.DoesNotExist:
-            return None
+    def get_id_by_short_code(cls, code):
+        """
+        Возвращает id рецепта по короткому коду или None.
+
+        Результат кэшируется: переход по короткой ссылке обычно
+        не требует обращения к БД.
+        """
+        cache_key = SHORT_CODE_CACHE_KEY.format(code)
+        recipe_id = cache.get(cache_key)
+        if recipe_id is None:
+            # Код уникален, поэтому достаточно LIMIT 1 по его индексу.
+            # Срез вместо first(): first() на запросе без сортировки
+            # сам добавляет ORDER BY id
+            recipe_ids = (
+                cls.objects.filter(short_url_code=code)
+                .order_by()
+                .values_list('id', flat=True)[:1]
+            )
+            recipe_id = recipe_ids[0] if recipe_ids else None
+            if recipe_id is not None:
+                cache.set(cache_key, recipe_id, SHORT_CODE_CACHE_TIMEOUT)
+        return recipe_id
 
     def get_absolute_url(self):
         """Генерирует абсолютный URL для рецепта."""
@@ -398,12 +584,20 @@ class Recipe(models.Model):
             # Если код не установлен, генерируем его
             self.short_url_code = self.generate_short()
             self.save(update_fields=['short_url_code'])
-        return reverse('recipes:short_link', args=[self.short_url_code])
+        return reverse('short_url', args=[self.short_url_code])
 
     def __str__(self):
         return self.name
 
 
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def reset_short_code_cache(instance, **kwargs):
+    """Убирает из кэша короткий код сохранённого или удалённого рецепта."""
+    if instance.short_url_code:
+        cache.delete(SHORT_CODE_CACHE_KEY.format(instance.short_url_code))
+
+
 class RecipeIngredient(models.Model):
     """Промежуточная модель для связи рецептов и ингредиентов."""
 
@@ -473,6 +667,14 @@ class BaseUserRecipeModel(models.Model):
     class Meta:
         abstract = True
         ordering = ('-created_at',)
+        # Индекс (user, recipe) уже создаёт уникальное ограничение,
+        # обратный порядок нужен для выборок по рецепту.
+        indexes = (
+            models.Index(
+                fields=('recipe', 'user'),
+                name='%(class)s_recipe_user_idx',
+            ),
+        )
 
     def clean(self):
         """Базовая валидация для связей пользователь-рецепт."""
@@ -481,15 +683,6 @@ class BaseUserRecipeModel(models.Model):
         if not self.recipe_id:
             raise ValidationError("Recipe is required")
 
-        # Проверяем существование рецепта
-        if not Recipe.objects.filter(id=self.recipe_id).exists():
-            raise ValidationError("Recipe does not exist")
-
-    def save(self, *args, **kwargs):
-        """Сохраняет с валидацией."""
-        self.full_clean()
-        super().save(*args, **kwargs)
-
     def __str__(self):
         return f'{self.user} - {self.recipe}'
 
@@ -522,3 +715,106 @@ class ShoppingCart(BaseUserRecipeModel):
                 name='unique_shopping_cart_recipe',
             ),
         ]
+
+    @classmethod
+    def build_summary(cls, user):
+        """
+        Суммирует продукты из корзины пользователя одним GROUP BY запросом.
+
+        Возвращает QuerySet словарей с ключами ingredient__name,
+        ingredient__measurement_unit и total_amount.
+        """
+        return (
+            RecipeIngredient.objects
+            .filter(recipe__shoppingcarts__user=user)
+            .values('ingredient__name', 'ingredient__measurement_unit')
+            .annotate(total_amount=Sum('amount'))
+            .order_by('ingredient__name')
+        )
+
+    @classmethod
+    def get_cached_summary(cls, user):
+        """
+        Возвращает продукты корзины (как build_summary) и названия рецептов.
+
+        Результат кэшируется под версией корзины пользователя. Версия
+        сбрасывается после изменения строк корзины, сохранения рецепта
+        из неё или его продуктов (set_ingredient_amounts), а также после
+        правки или удаления продукта. Изменения в обход этих путей
+        (другой процесс, queryset.update) видны не позже чем через
+        SHOPPING_CART_CACHE_TIMEOUT секунд.
+        """
+        version = cache.get_or_set(
+            SHOPPING_CART_VERSION_KEY.format(user.pk),
+            lambda: urandom(8).hex(),
+            None,
+        )
+        cache_key = SHOPPING_CART_CACHE_KEY.format(user.pk, version)
+        summary = cache.get(cache_key)
+        if summary is None:
+            summary = (
+                list(cls.build_summary(user)),
+                # EXISTS вместо JOIN + DISTINCT: без сортировки для дублей
+                list(
+                    Recipe.objects.filter(Exists(
+                        cls.objects.filter(user=user, recipe=OuterRef('pk'))
+                    )).values_list('name', flat=True)
+                ),
+            )
+            cache.set(cache_key, summary, SHOPPING_CART_CACHE_TIMEOUT)
+        return summary
+
+    @staticmethod
+    def reset_cached_summaries(carts):
+        """Сбрасывает версии корзин после фиксации транзакции."""
+        keys = {
+            SHOPPING_CART_VERSION_KEY.format(user_id)
+            for user_id in carts.values_list('user_id', flat=True)
+        }
+        if keys:
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @staticmethod
+    def reset_cached_summary(user_id):
+        """Сбрасывает версию корзины одного пользователя."""
+        version_key = SHOPPING_CART_VERSION_KEY.format(user_id)
+        transaction.on_commit(lambda: cache.delete(version_key))
+
+
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_delete, sender=ShoppingCart)
+def reset_shopping_cart_summary(instance, **kwargs):
+    """Сбрасывает кэш списка покупок владельца корзины."""
+    ShoppingCart.reset_cached_summary(instance.user_id)
+
+
+@receiver(post_save, sender=Recipe)
+def reset_recipe_carts_summary(instance, created, **kwargs):
+    """Сбрасывает кэш списков покупок с изменённым рецептом."""
+    if not created:
+        ShoppingCart.reset_cached_summaries(
+            ShoppingCart.objects.filter(recipe=instance)
+        )
+
+
+@receiver(post_save, sender=Ingredient)
+def reset_ingredient_carts_summary(instance, created, **kwargs):
+    """Сбрасывает кэш списков покупок с переименованным продуктом."""
+    if not created:
+        ShoppingCart.reset_cached_summaries(
+            ShoppingCart.objects.filter(
+                recipe__recipe_ingredients__ingredient=instance
+            )
+        )
+
+
+@receiver(pre_delete, sender=Ingredient)
+def reset_deleted_ingredient_carts_summary(instance, **kwargs):
+    """Сбрасывает кэш списков покупок с удаляемым продуктом."""
+    # Строки рецептов удаляются каскадом без сигналов, а после удаления
+    # связь с корзинами уже не найти: корзины собираются заранее
+    ShoppingCart.reset_cached_summaries(
+        ShoppingCart.objects.filter(
+            recipe__recipe_ingredients__ingredient=instance
+        )
+    )
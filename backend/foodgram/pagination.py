@@ -1,6 +1,74 @@
+from hashlib import md5
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
 from rest_framework.pagination import PageNumberPagination
 
+COUNT_CACHE_KEY = 'paginator_count:{}'
+COUNT_CACHE_TIMEOUT = 30
+
+
+class OptimizedPaginator(Paginator):
+    """
+    Paginator, который считает записи без сортировки и аннотаций.
+
+    COUNT строится по order_by().values('pk'): из запроса уходят ORDER BY
+    и вычисляемые поля выборки, а аннотации, участвующие в фильтрах,
+    остаются в WHERE.
+    """
+
+    def get_count_queryset(self):
+        if not isinstance(self.object_list, QuerySet):
+            return None
+        return self.object_list.order_by().values('pk')
+
+    @cached_property
+    def count(self):
+        count_queryset = self.get_count_queryset()
+        if count_queryset is None:
+            return super().count
+        return count_queryset.count()
+
+
+class CachedCountPaginator(OptimizedPaginator):
+    """
+    Paginator, который кэширует COUNT(*) на короткое время.
+
+    Ключ строится по SQL и параметрам запроса, поэтому фильтры и флаги
+    пользователя получают собственные записи; новое значение появится
+    не позже чем через COUNT_CACHE_TIMEOUT секунд.
+    """
+
+    @cached_property
+    def count(self):
+        count_queryset = self.get_count_queryset()
+        if count_queryset is None:
+            return super().count
+        sql, params = count_queryset.query.sql_with_params()
+        cache_key = COUNT_CACHE_KEY.format(
+            md5(f'{sql}{params}'.encode()).hexdigest()
+        )
+        count = cache.get(cache_key)
+        if count is None:
+            count = super().count
+            cache.set(cache_key, count, COUNT_CACHE_TIMEOUT)
+        return count
+
 
 class LimitPageNumberPagination(PageNumberPagination):
+    django_paginator_class = OptimizedPaginator
     page_size_query_param = 'limit'
     max_page_size = 6
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # Кэшируется только общий список без фильтров: после изменения
+        # избранного или подписок пользователь сразу видит точный count
+        unfiltered = not (
+            request.query_params.keys()
+            - {self.page_query_param, self.page_size_query_param}
+        )
+        if unfiltered and getattr(view, 'cache_pagination_count', False):
+            self.django_paginator_class = CachedCountPaginator
+        return super().paginate_queryset(queryset, request, view)
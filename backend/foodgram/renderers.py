@@ -0,0 +1,21 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer на orjson для больших однотипных списков.
+
+    Ответ с отступами (indent в Accept) и данные, которые orjson
+    не умеет сериализовать, отдаются стандартным рендерером DRF.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not self.get_indent(accepted_media_type, renderer_context or {}):
+            try:
+                return orjson.dumps(data)
+            except orjson.JSONEncodeError:
+                pass
+        return super().render(data, accepted_media_type, renderer_context)
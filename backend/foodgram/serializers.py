@@ -1,28 +1,128 @@
 from collections import Counter
+from contextlib import contextmanager
+from copy import deepcopy
+from functools import cached_property
+from operator import attrgetter
 
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    OuterRef, Prefetch, Subquery, prefetch_related_objects
+)
 from djoser.serializers import UserSerializer as DjoserSerializer
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 from rest_framework.serializers import ValidationError
 
 from .models import (
-    Favorite,
     Ingredient,
     Recipe,
     RecipeIngredient,
-    ShoppingCart,
     Subscription,
     Tag,
+    get_reference_map,
+    load_reference_map,
 )
 
 
 User = get_user_model()
 
+PLAIN_REPRESENTATION_FIELDS = (serializers.IntegerField, serializers.CharField)
+
+REFERENCES_CHANGED_ERROR = (
+    'Продукты или теги рецепта были удалены, обновите данные'
+)
+
+
+def find_duplicates(identifiers):
+    """Возвращает повторяющиеся идентификаторы в порядке появления."""
+    # Обычно дублей нет: тогда хватает сравнения длин без подсчёта
+    if len(identifiers) == len(set(identifiers)):
+        return []
+    return [
+        item_id for item_id, count in Counter(identifiers).items()
+        if count > 1
+    ]
+
+
+class ReferencePrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField для справочников (теги, продукты).
+
+    Объекты берутся из кэша load_reference_map, поэтому список из N
+    известных идентификаторов проверяется без N отдельных запросов к БД;
+    незнакомый id перед ошибкой проверяется одним запросом.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return load_reference_map(self.get_queryset().model, (pk,))[pk]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+
+
+class MediaURLField(serializers.ImageField):
+    """
+    Абсолютная ссылка на файл для ответов API.
+
+    Схема и хост запроса вычисляются один раз на поле, а не через
+    build_absolute_uri для каждой строки списка.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    @cached_property
+    def base_url(self):
+        request = self.context.get('request')
+        return request.build_absolute_uri('/')[:-1] if request else ''
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = value.url
+        # Внешние хранилища (S3 и т.п.) уже отдают абсолютный адрес
+        if not url.startswith('/') or url.startswith('//'):
+            return url
+        return self.base_url + url
+
+
+class CachedFieldsMixin:
+    """
+    Кэширует набор полей ModelSerializer на уровне класса.
+
+    Построение полей по модели (интроспекция Meta и полей модели)
+    выполняется один раз на класс; экземпляры получают копию.
+    """
+
+    _fields_cache = {}
 
-class UserSerializer(DjoserSerializer):
+    def get_fields(self):
+        serializer_class = type(self)
+        if serializer_class not in self._fields_cache:
+            self._fields_cache[serializer_class] = super().get_fields()
+        return deepcopy(self._fields_cache[serializer_class])
+
+
+class CurrentUserMixin:
+    """Пользователь запроса, вычисляемый один раз на экземпляр."""
+
+    @cached_property
+    def current_user(self):
+        # Для many=True дочерний сериализатор один на весь список, поэтому
+        # SimpleLazyObject из request.user разворачивается один раз
+        return self.context['request'].user
+
+
+class UserSerializer(CachedFieldsMixin, CurrentUserMixin, DjoserSerializer):
     is_subscribed = serializers.SerializerMethodField()
 
     class Meta:
@@ -33,15 +133,31 @@ class UserSerializer(DjoserSerializer):
             'is_subscribed'
         )
 
-    def get_is_subscribed(self, author_obj):
-        current_user = self.context.get('request').user
-        return (
-            current_user.is_authenticated
-            and Subscription.objects.filter(
-                author=author_obj, subscriber=current_user
-            ).exists()
+    @classmethod
+    def only_model_fields(cls, queryset):
+        """Ограничивает выборку колонками, которые читает сериализатор."""
+        # Пароль, даты и флаги доступа в ответ не попадают
+        model_fields = {field.name for field in User._meta.concrete_fields}
+        return queryset.only(
+            *(name for name in cls.Meta.fields if name in model_fields)
         )
 
+    def get_is_subscribed(self, author_obj):
+        if hasattr(author_obj, 'is_subscribed_ann'):
+            return author_obj.is_subscribed
+        current_user = self.current_user
+        # На себя подписаться нельзя (см. prevent_self_subscription),
+        # поэтому /users/me/ отвечает без запроса к подпискам
+        if (
+            not current_user.is_authenticated
+            or author_obj.id == current_user.id
+        ):
+            return False
+        # Без аннотации with_subscription_flag проверяется одна пара
+        return Subscription.objects.filter(
+            subscriber=current_user, author=author_obj
+        ).exists()
+
 
 class UserCreateSerializer(DjoserSerializer):
     first_name = serializers.CharField(required=True, max_length=150)
@@ -72,20 +188,22 @@ class AvatarSerializer(serializers.ModelSerializer):
         fields = ('avatar',)
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(CachedFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = '__all__'
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(CachedFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Ingredient
         fields = '__all__'
 
 
-class RecipeIngredientSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
+class RecipeIngredientSerializer(
+    CachedFieldsMixin, serializers.ModelSerializer
+):
+    id = ReferencePrimaryKeyField(
         queryset=Ingredient.objects.all(), source='ingredient'
     )
     name = serializers.ReadOnlyField(source='ingredient.name')
@@ -106,12 +224,13 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
-class ReadRecipeSerializer(serializers.ModelSerializer):
-    tags = TagSerializer(many=True)
+class ReadRecipeSerializer(
+    CachedFieldsMixin, CurrentUserMixin, serializers.ModelSerializer
+):
+    tags = serializers.SerializerMethodField()
     author = UserSerializer(read_only=True)
-    ingredients = RecipeIngredientSerializer(
-        source='recipe_ingredients', many=True
-    )
+    ingredients = serializers.SerializerMethodField()
+    image = MediaURLField()
     is_in_shopping_cart = serializers.SerializerMethodField()
     is_favorited = serializers.SerializerMethodField()
 
@@ -133,28 +252,94 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
             'id', 'author', 'is_in_shopping_cart', 'is_favorited'
         )
 
-    def get_is_in_shopping_cart(self, recipe_obj):
-        current_user = self.context.get('request').user
-        return (
-            current_user.is_authenticated
-            and ShoppingCart.objects.filter(
-                user=current_user, recipe=recipe_obj
-            ).exists()
+    @staticmethod
+    def prefetch_queryset(queryset, user):
+        """Подгружает всё, что читает сериализатор, пакетными запросами."""
+        queryset = queryset.with_user_flags(user).prefetch_related(
+            'tags',
+            Prefetch(
+                'recipe_ingredients',
+                queryset=RecipeIngredient.objects.select_related(
+                    'ingredient'
+                ),
+            ),
         )
+        if not user.is_authenticated:
+            return queryset.select_related('author')
+        # Авторы грузятся одним запросом сразу с флагом подписки
+        return queryset.prefetch_related(Prefetch(
+            'author', queryset=User.objects.with_subscription_flag(user)
+        ))
+
+    @cached_property
+    def representation_getters(self):
+        """Пары (ключ, функция значения) в порядке Meta.fields."""
+        # Для many=True дочерний сериализатор один на весь список,
+        # поэтому поля разбираются один раз на ответ, а не на строку
+        getters = []
+        for field in self._readable_fields:
+            if isinstance(field, serializers.SerializerMethodField):
+                getter = getattr(self, field.method_name)
+            elif (
+                type(field) in PLAIN_REPRESENTATION_FIELDS
+                and len(field.source_attrs) == 1
+            ):
+                # Простые числовые и строковые колонки отдаются как есть:
+                # to_representation для них лишь повторяет int() и str()
+                getter = attrgetter(field.source)
+            else:
+                def getter(recipe_obj, field=field):
+                    attribute = field.get_attribute(recipe_obj)
+                    if attribute is None:
+                        return None
+                    return field.to_representation(attribute)
+            getters.append((field.field_name, getter))
+        return tuple(getters)
+
+    def to_representation(self, recipe_obj):
+        # Тип каждого поля разбирается один раз в representation_getters,
+        # а не для каждой строки списка
+        return {
+            name: getter(recipe_obj)
+            for name, getter in self.representation_getters
+        }
+
+    def get_tags(self, recipe_obj):
+        # Формат TagSerializer без вложенного сериализатора на каждый тег
+        return [
+            {
+                'id': tag.id,
+                'name': tag.name,
+                'slug': tag.slug,
+                'color': tag.color,
+            }
+            for tag in recipe_obj.tags.all()
+        ]
+
+    def get_ingredients(self, recipe_obj):
+        # Тот же формат, что у RecipeIngredientSerializer, но без
+        # вложенного сериализатора на каждую строку; данные берутся
+        # из prefetch_related, запросов не добавляется
+        return [
+            {
+                'id': component.ingredient.id,
+                'name': component.ingredient.name,
+                'measurement_unit': component.ingredient.measurement_unit,
+                'amount': component.amount,
+            }
+            for component in recipe_obj.recipe_ingredients.all()
+        ]
+
+    def get_is_in_shopping_cart(self, recipe_obj):
+        return recipe_obj.is_in_shopping_cart_of(self.current_user)
 
     def get_is_favorited(self, recipe_obj):
-        current_user = self.context.get('request').user
-        return (
-            current_user.is_authenticated
-            and Favorite.objects.filter(
-                user=current_user, recipe=recipe_obj
-            ).exists()
-        )
+        return recipe_obj.is_favorited_by(self.current_user)
 
 
 class WriteRecipeSerializer(serializers.ModelSerializer):
     ingredients = RecipeIngredientSerializer(many=True, required=True)
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = ReferencePrimaryKeyField(
         queryset=Tag.objects.all(),
         many=True,
         required=True
@@ -184,6 +369,28 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
         )
         read_only_fields = ('id', 'author')
 
+    @staticmethod
+    def prefetch_queryset(queryset, user):
+        """Для записи связанные объекты заранее не нужны."""
+        return queryset
+
+    def to_representation(self, recipe_instance):
+        # Ответ на запись совпадает с чтением рецепта; связи
+        # подгружаются так же пакетно, как и в списке
+        prefetch_related_objects(
+            (recipe_instance,),
+            'tags',
+            Prefetch(
+                'recipe_ingredients',
+                queryset=RecipeIngredient.objects.select_related(
+                    'ingredient'
+                ),
+            ),
+        )
+        return ReadRecipeSerializer(
+            recipe_instance, context=self.context
+        ).data
+
     def validate_ingredients(self, components_data):
         if not components_data:
             raise ValidationError('Требуются ингредиенты для рецепта')
@@ -191,31 +398,13 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
         ingredient_identifiers = [
             item['ingredient'].id for item in components_data
         ]
-        duplicate_items = [item_id for item_id, count in Counter(
-            ingredient_identifiers
-        ).items() if count > 1]
+        duplicate_items = find_duplicates(ingredient_identifiers)
 
         if duplicate_items:
             raise ValidationError(
                 f'Повторяющиеся ингредиенты: {duplicate_items}'
             )
 
-        exist_ingredient = set(Ingredient.objects.filter(
-            id__in=ingredient_identifiers
-        ).values_list('id', flat=True))
-
-        missing_ingredient_ids = set(ingredient_identifiers) - exist_ingredient
-        if missing_ingredient_ids:
-            raise ValidationError(
-                f"Не найдены ингредиенты с ID: {missing_ingredient_ids}"
-            )
-
-        for component_item in components_data:
-            if component_item['amount'] < 1:
-                raise ValidationError(
-                    "Количество должно быть положительным числом"
-                )
-
         return components_data
 
     def validate_tags(self, tags_data):
@@ -223,22 +412,11 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
             raise ValidationError('Необходимо указать теги')
 
         tag_identifiers = [tag.id for tag in tags_data]
-        duplicate_tags = [tag_id for tag_id, count in Counter(
-            tag_identifiers
-        ).items() if count > 1]
+        duplicate_tags = find_duplicates(tag_identifiers)
 
         if duplicate_tags:
             raise ValidationError(f'Повторяющиеся теги: {duplicate_tags}')
 
-        existing_tag_ids = set(
-            Tag.objects.filter(
-                id__in=tag_identifiers
-            ).values_list('id', flat=True)
-        )
-        missing_tag_ids = set(tag_identifiers) - existing_tag_ids
-        if missing_tag_ids:
-            raise ValidationError(f"Не найдены теги с ID: {missing_tag_ids}")
-
         return tags_data
 
     def validate(self, data_dict):
@@ -250,54 +428,147 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
 
         return data_dict
 
-    @transaction.atomic
     def create(self, validated_data_dict):
         components_info = validated_data_dict.pop('ingredients')
         tags_info = validated_data_dict.pop('tags')
 
-        new_recipe = Recipe.objects.create(**validated_data_dict)
-        new_recipe.tags.set(tags_info)
-
-        recipe_component_list = []
-        for component_info in components_info:
-            recipe_component_list.append(
-                RecipeIngredient(
-                    recipe=new_recipe,
-                    ingredient=component_info['ingredient'],
-                    amount=component_info['amount']
-                )
-            )
-
-        RecipeIngredient.objects.bulk_create(recipe_component_list)
+        with self.stored_image(validated_data_dict), self.references_guard(
+            tags_info, components_info
+        ):
+            new_recipe = Recipe.objects.create(**validated_data_dict)
+            new_recipe.tags.set(tags_info)
+            self.create_components(new_recipe, components_info)
         return new_recipe
 
-    @transaction.atomic
     def update(self, recipe_instance, validated_data_dict):
         components_info = validated_data_dict.pop('ingredients', None)
         tags_info = validated_data_dict.pop('tags', None)
 
-        updated_recipe = super().update(recipe_instance, validated_data_dict)
-
-        if tags_info is not None:
-            updated_recipe.tags.set(tags_info)
-
-        if components_info is not None:
-            updated_recipe.ingredients.clear()
-            recipe_component_list = []
-            for component_info in components_info:
-                recipe_component_list.append(
-                    RecipeIngredient(
-                        recipe=updated_recipe,
-                        ingredient=component_info['ingredient'],
-                        amount=component_info['amount']
-                    )
-                )
-            RecipeIngredient.objects.bulk_create(recipe_component_list)
+        with self.stored_image(validated_data_dict), self.references_guard(
+            tags_info, components_info
+        ):
+            updated_recipe = super().update(
+                recipe_instance, validated_data_dict
+            )
+
+            if tags_info is not None:
+                updated_recipe.tags.set(tags_info)
+
+            if components_info is not None:
+                updated_recipe.set_ingredient_amounts({
+                    component_info['ingredient'].id: component_info['amount']
+                    for component_info in components_info
+                })
 
         return updated_recipe
 
+    @staticmethod
+    @contextmanager
+    def stored_image(validated_data_dict):
+        """
+        Записывает картинку в хранилище до начала транзакции.
+
+        В модель попадает уже сохранённое имя файла, поэтому запись
+        на диск или в S3 не удерживает открытую транзакцию. Если запись
+        рецепта не удалась, файл удаляется из хранилища.
+        """
+        image = validated_data_dict.get('image')
+        if image is None:
+            yield
+            return
+        image_field = Recipe._meta.get_field('image')
+        stored_name = image_field.storage.save(
+            image_field.generate_filename(None, image.name), image
+        )
+        validated_data_dict['image'] = stored_name
+        try:
+            yield
+        except Exception:
+            image_field.storage.delete(stored_name)
+            raise
+
+    @staticmethod
+    @contextmanager
+    def references_guard(tags_info, components_info):
+        """
+        Транзакция записи рецепта.
+
+        Существование продуктов и тегов повторно не проверяется запросом:
+        если справочник удалили после валидации, это поймает внешний ключ.
+        Тогда переданные id перепроверяются, и пропавшие записи
+        возвращаются клиенту как ошибка валидации; прочие ошибки
+        целостности пробрасываются без изменений.
+        """
+        try:
+            with transaction.atomic():
+                yield
+        except IntegrityError:
+            tag_ids = {tag.id for tag in tags_info or ()}
+            ingredient_ids = {
+                component_info['ingredient'].id
+                for component_info in components_info or ()
+            }
+            if (
+                Tag.objects.filter(pk__in=tag_ids).count() == len(tag_ids)
+                and Ingredient.objects.filter(
+                    pk__in=ingredient_ids
+                ).count() == len(ingredient_ids)
+            ):
+                raise
+            # Запись справочника удалили в другом процессе, и сигнал
+            # не сбросил карту здесь: перечитываем её при следующем запросе
+            get_reference_map.cache_clear()
+            raise ValidationError(REFERENCES_CHANGED_ERROR)
+
+    @staticmethod
+    def create_components(recipe, components_info):
+        RecipeIngredient.objects.bulk_create(
+            (
+                RecipeIngredient(
+                    recipe=recipe,
+                    ingredient_id=component_info['ingredient'].id,
+                    amount=component_info['amount']
+                )
+                for component_info in components_info
+            ),
+            batch_size=500,
+        )
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=100,
+    )
+
+    def validate_recipes(self, recipe_ids):
+        # Повторы не ошибка: добавить рецепт дважды нельзя и так
+        return list(dict.fromkeys(recipe_ids))
+
+
+class ShortRecipeSerializer(CachedFieldsMixin, serializers.ModelSerializer):
+    image = MediaURLField()
+
+    @classmethod
+    def as_prefetch(cls, lookup, limit=None):
+        """
+        Prefetch рецептов только с полями этого сериализатора.
+
+        С limit из БД приходят лишь limit последних рецептов каждого
+        автора: коррелированный подзапрос идёт по индексу
+        (author, pub_date), лишние строки не передаются.
+        """
+        # author нужен, чтобы связать рецепты с авторами при prefetch
+        queryset = Recipe.objects.only(*cls.Meta.fields, 'author')
+        if limit is not None:
+            queryset = queryset.filter(pk__in=Subquery(
+                Recipe.objects.filter(
+                    author=OuterRef('author')
+                ).values('pk')[:limit]
+            ))
+        return Prefetch(lookup, queryset=queryset)
 
-class ShortRecipeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Recipe
         fields = (
@@ -310,19 +581,29 @@ class ShortRecipeSerializer(serializers.ModelSerializer):
 
 class ReadSubscriptionSerializer(UserSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.ReadOnlyField(source='recipes.count')
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta(UserSerializer.Meta):
         fields = (*UserSerializer.Meta.fields, 'recipes', 'recipes_count')
 
-    def get_recipes(self, user_obj):
-        limit_value = self.context.get('request').GET.get(
-            'recipes_limit', 10**10
+    @classmethod
+    def prefetch_queryset(cls, queryset, recipes_limit=None):
+        """Добавляет число рецептов и сами рецепты авторов."""
+        queryset = cls.only_model_fields(queryset)
+        return queryset.with_recipes_count().prefetch_related(
+            ShortRecipeSerializer.as_prefetch('recipes', recipes_limit)
         )
+
+    def get_is_subscribed(self, author_obj):
+        # Сериализатор отдаёт только авторов, на которых уже подписан
+        # текущий пользователь: список подписок и ответ на подписку
+        return True
+
+    def get_recipes(self, user_obj):
+        # При prefetch_related срез берётся из кэша без запросов,
+        # без него превращается в LIMIT в SQL, а не в выборку всех рецептов
         return ShortRecipeSerializer(
-            user_obj.recipes.all()[
-                : int(limit_value)
-            ],
+            user_obj.recipes.all()[:self.context.get('recipes_limit')],
             context=self.context,
             many=True,
         ).data
@@ -1,52 +1,34 @@
 from django.utils import timezone
-from io import BytesIO
 
 TIME_FORMAT = '%d-%m-%Y %H:%M'
 
 
-def make_shopping_cart_file(ingredients, recipes):
+def iter_shopping_cart_file(ingredients, recipe_names):
     """
-    Создает файл списка покупок в памяти.
+    Построчно отдает файл списка покупок в кодировке UTF-8.
+
+    Файл не собирается в памяти целиком: каждая строка кодируется
+    и передается клиенту по мере формирования.
 
     Args:
-        ingredients: QuerySet ингредиентов с аннотацией total_amount
-        recipes: QuerySet рецептов
+        ingredients: строки ингредиентов с аннотацией total_amount
+        recipe_names: названия рецептов из корзины
     """
     current_time = timezone.now().strftime(TIME_FORMAT)
+    yield f'Дата и время: {current_time}\n\nСписок покупок:\n'.encode()
 
     # Форматируем ингредиенты
-    ingredients_list = []
     for index, item in enumerate(ingredients, start=1):
         ingredient_name = item["ingredient__name"].capitalize()
         measurement_unit = item["ingredient__measurement_unit"]
         total_amount = item["total_amount"]
 
-        ingredients_list.append(
-            f'{index}. {ingredient_name} ({measurement_unit}) - {total_amount}'
-        )
+        yield (
+            f'{index}. {ingredient_name} ({measurement_unit}) - '
+            f'{total_amount}\n'
+        ).encode()
 
     # Форматируем рецепты
-    recipes_list = []
-    for index, recipe in enumerate(recipes, start=1):
-        recipes_list.append(f'{index}. {recipe.name}')
-
-    # Собираем содержимое
-    content_lines = [
-        f'Дата и время: {current_time}',
-        '',
-        'Список покупок:',
-        *ingredients_list,
-        '',
-        'Список рецептов:',
-        *recipes_list,
-        ''
-    ]
-
-    content = '\n'.join(content_lines)
-
-    # Создаем файл в памяти
-    file_buffer = BytesIO()
-    file_buffer.write(content.encode('utf-8'))
-    file_buffer.seek(0)
-
-    return file_buffer
+    yield '\nСписок рецептов:\n'.encode()
+    for index, recipe_name in enumerate(recipe_names, start=1):
+        yield f'{index}. {recipe_name}\n'.encode()
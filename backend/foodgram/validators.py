@@ -1,20 +1,23 @@
-import re
 from django.core.exceptions import ValidationError
 
+# Помимо букв и цифр (как \w в регулярных выражениях)
+ALLOWED_SYMBOLS = frozenset('_.@+-')
+BANNED_NAMES = frozenset({'me', 'admin', 'administrator', 'root', 'superuser'})
+
 
 def validate_username(username):
     """Валидация имени пользователя."""
 
-    ALLOWED_PATTERN = r'[\w.@+-]'
-    BANNED_NAMES = {'me', 'admin', 'administrator', 'root', 'superuser'}
-
-    invalid_chars = set(re.sub(ALLOWED_PATTERN, '', username))
+    invalid_chars = {
+        char for char in username
+        if not char.isalnum() and char not in ALLOWED_SYMBOLS
+    }
     if invalid_chars:
         raise ValidationError(
             f'Недопустимые символы: {"".join(invalid_chars)}'
         )
 
-    if username.lower() in {name.lower() for name in BANNED_NAMES}:
+    if username.lower() in BANNED_NAMES:
         raise ValidationError(f'Имя "{username}" запрещено')
 
     return username
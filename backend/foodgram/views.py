@@ -1,36 +1,71 @@
 from http import HTTPStatus
-from django.http import HttpResponsePermanentRedirect
+from django.http import Http404, HttpResponsePermanentRedirect
 
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
-from django.http import FileResponse
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import parse_etags, quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as DjoserUserViewSet
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import SAFE_METHODS, AllowAny, IsAuthenticated
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
 from .models import (
+    REFERENCE_VERSION_TIMEOUT,
     Favorite,
     Ingredient,
     Recipe,
-    RecipeIngredient,
     ShoppingCart,
     Subscription,
     Tag,
+    get_reference_version,
 )
 
-from . import filters, pagination, permissions, serializers, utils
+from . import (
+    filters, pagination, permissions, renderers, serializers, utils
+)
 
 
 User = get_user_model()
 
+REFERENCE_CACHE_KEY = 'reference_response:{}:{}'
+# Ответ под истёкшей версией уже не читается: храним не дольше версии
+REFERENCE_CACHE_TIMEOUT = REFERENCE_VERSION_TIMEOUT
+
 
 class UserViewSet(DjoserUserViewSet):
+    def get_subscription_context(self):
+        """Контекст сериализатора подписок с разобранным recipes_limit."""
+        # Лимит одинаков для всех авторов: разбираем его один раз на запрос
+        limit_value = self.request.query_params.get('recipes_limit')
+        recipes_limit = None
+        if limit_value is not None:
+            try:
+                recipes_limit = int(limit_value)
+            except ValueError:
+                recipes_limit = -1
+            if recipes_limit < 0:
+                raise ValidationError(
+                    {'recipes_limit': 'Ожидается неотрицательное целое число'}
+                )
+        return {'request': self.request, 'recipes_limit': recipes_limit}
+
+    def get_queryset(self):
+        queryset = super().get_queryset().with_subscription_flag(
+            self.request.user
+        )
+        if self.action in ('list', 'retrieve'):
+            return serializers.UserSerializer.only_model_fields(queryset)
+        return queryset
+
     def get_permission_list(self):
         if self.action == 'me':
             return (IsAuthenticated(),)
@@ -47,12 +82,15 @@ class UserViewSet(DjoserUserViewSet):
     def avatar(self, request):
         current_user = request.user
         if request.method == 'DELETE':
-            current_user.avatar.delete(save=True)
+            # Файл удаляется из хранилища, а в БД обнуляется одна колонка
+            # без полного save() пользователя
+            current_user.avatar.delete(save=False)
+            User.objects.filter(pk=current_user.pk).update(avatar=None)
             return Response(status=HTTPStatus.NO_CONTENT)
         avatar_serializer = serializers.AvatarSerializer(data=request.data)
         avatar_serializer.is_valid(raise_exception=True)
         current_user.avatar = avatar_serializer.validated_data['avatar']
-        current_user.save()
+        current_user.save(update_fields=('avatar',))
         return Response(
             serializers.AvatarSerializer(current_user).data,
             status=HTTPStatus.OK,
@@ -64,14 +102,19 @@ class UserViewSet(DjoserUserViewSet):
         pagination_class=pagination.LimitPageNumberPagination,
     )
     def subscriptions(self, request):
-        subscribed_authors = User.objects.filter(
-            authors__subscriber=request.user
+        context = self.get_subscription_context()
+        subscribed_authors = (
+            serializers.ReadSubscriptionSerializer.prefetch_queryset(
+                User.objects.filter(authors__subscriber=request.user),
+                context['recipes_limit'],
+            )
+            .order_by('username')
         )
         page = self.paginate_queryset(subscribed_authors)
         subscription_serializer = serializers.ReadSubscriptionSerializer(
             page,
             many=True,
-            context={'request': request},
+            context=context,
         )
         return self.get_paginated_response(subscription_serializer.data)
 
@@ -81,64 +124,117 @@ class UserViewSet(DjoserUserViewSet):
     )
     def subscribe(self, request, id):
         subscriber = request.user
-        author_to_subscribe = get_object_or_404(User, pk=id)
 
         if request.method == 'DELETE':
-            subscription = get_object_or_404(
-                Subscription,
-                author=author_to_subscribe,
-                subscriber=subscriber
-            )
-            subscription.delete()
+            # Автор не загружается: число удалённых строк покрывает
+            # и отсутствие подписки, и несуществующего автора
+            deleted, _ = Subscription.objects.filter(
+                author_id=id, subscriber=subscriber
+            ).delete()
+            if not deleted:
+                raise Http404
             return Response(status=HTTPStatus.NO_CONTENT)
 
+        author_to_subscribe = get_object_or_404(
+            User.objects.with_recipes_count(), pk=id
+        )
+
         if subscriber == author_to_subscribe:
             raise ValidationError(
                 {'error': 'Подписка на собственный аккаунт невозможна'}
             )
 
-        subscription, created = Subscription.objects.get_or_create(
-            author=author_to_subscribe, subscriber=subscriber
-        )
-        if not created:
+        try:
+            with transaction.atomic():
+                Subscription.objects.create(
+                    author=author_to_subscribe, subscriber=subscriber
+                )
+        except IntegrityError:
             raise ValidationError(
                 {'error': 'Подписка на этого автора уже активна'}
             )
 
+        context = self.get_subscription_context()
+        prefetch_related_objects(
+            (author_to_subscribe,),
+            serializers.ShortRecipeSerializer.as_prefetch(
+                'recipes', context['recipes_limit']
+            ),
+        )
         return Response(
             serializers.ReadSubscriptionSerializer(
-                author_to_subscribe, context={'request': request}
+                author_to_subscribe, context=context
             ).data,
             status=HTTPStatus.CREATED,
         )
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class CachedReferenceMixin:
+    """
+    Кэширует ответы справочника под его версией.
+
+    Данные ответа хранятся в кэше под версией справочника, а сама
+    версия отдается как ETag: повторный запрос браузера получает 304.
+    Версия живёт REFERENCE_VERSION_TIMEOUT секунд, поэтому изменения
+    из другого процесса доходят до клиентов с той же задержкой.
+    """
+
+    def cached_response(self, view_method, request, *args, **kwargs):
+        version = get_reference_version(self.queryset.model)
+        etag = quote_etag(version)
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(
+                status=HTTPStatus.NOT_MODIFIED, headers={'ETag': etag}
+            )
+        cache_key = REFERENCE_CACHE_KEY.format(
+            version, request.get_full_path()
+        )
+        data = cache.get(cache_key)
+        if data is None:
+            response = view_method(request, *args, **kwargs)
+            if response.status_code != HTTPStatus.OK:
+                return response
+            data = response.data
+            cache.set(cache_key, data, REFERENCE_CACHE_TIMEOUT)
+        return Response(data, headers={'ETag': etag})
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+
+class TagViewSet(CachedReferenceMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = serializers.TagSerializer
     pagination_class = None
     permission_classes = (AllowAny,)
+    renderer_classes = (renderers.ORJSONRenderer, BrowsableAPIRenderer)
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(CachedReferenceMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = serializers.IngredientSerializer
     pagination_class = None
-    search_fields = ('^name',)
     permission_classes = (AllowAny,)
+    renderer_classes = (renderers.ORJSONRenderer, BrowsableAPIRenderer)
     filter_backends = (filters.IngredientFilter,)
 
 
 class RecipeViewSet(viewsets.ModelViewSet):
-    queryset = (
-        Recipe.objects.prefetch_related('tags', 'ingredients')
-        .select_related('author')
-        .all()
-    )
     permission_classes = (permissions.IsAuthorOrReadOnly,)
+    cache_pagination_count = True
     filter_backends = (DjangoFilterBackend,)
     filterset_class = filters.RecipeFilterSet
 
+    def get_queryset(self):
+        return self.get_serializer_class().prefetch_queryset(
+            Recipe.objects.all(), self.request.user
+        )
+
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
             return serializers.ReadRecipeSerializer
@@ -184,9 +280,12 @@ class RecipeViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, url_path='get-link')
     def get_recipe_link(self, request, pk=None):
-        recipe = get_object_or_404(Recipe, pk=pk)
+        # Код хранится в рецепте с момента создания: читается одна колонка
+        short_url_code = get_object_or_404(
+            Recipe.objects.values_list('short_url_code', flat=True), pk=pk
+        )
         short_url = request.build_absolute_uri(
-            reverse('short_url', args=(recipe.short_url_code,))
+            reverse('short_url', args=(short_url_code,))
         )
         return Response({'short-link': short_url}, status=HTTPStatus.OK)
 
@@ -200,38 +299,28 @@ class RecipeViewSet(viewsets.ModelViewSet):
         Генерация файла со списком покупок для пользователя.
         """
         try:
-            user_ingredients = (
-                RecipeIngredient.objects
-                .filter(recipe__shoppingcarts__user=request.user)
-                .values(
-                    'ingredient__name',
-                    'ingredient__measurement_unit',
-                )
-                .annotate(total_quantity=Sum('amount'))
-                .order_by('ingredient__name')
+            # Списки уже материализованы: пустая корзина проверяется без
+            # отдельного запроса, а ошибки БД не возникнут посреди потока
+            user_ingredients, recipe_names = ShoppingCart.get_cached_summary(
+                request.user
             )
 
-            user_recipes = Recipe.objects.filter(
-                shoppingcarts__user=request.user
-            ).distinct()
-
-            if not user_ingredients.exists():
+            if not user_ingredients:
                 return Response(
                     {'error': 'Ваша корзина покупок пуста'},
                     status=HTTPStatus.BAD_REQUEST
                 )
 
-            shopping_list_file = utils.make_shopping_cart_file(
-                user_ingredients,
-                user_recipes
-            )
-
-            response = FileResponse(
-                shopping_list_file,
-                as_attachment=True,
-                filename='shopping_list.txt',
+            response = StreamingHttpResponse(
+                utils.iter_shopping_cart_file(
+                    user_ingredients,
+                    recipe_names
+                ),
                 content_type='text/plain; charset=utf-8'
             )
+            response['Content-Disposition'] = (
+                'attachment; filename="shopping_list.txt"'
+            )
 
             return response
 
@@ -246,27 +335,75 @@ class RecipeViewSet(viewsets.ModelViewSet):
         self, request, error_message, recipe_id, relation_model
     ):
         user = request.user
-        recipe = get_object_or_404(Recipe, pk=recipe_id)
 
         if request.method == 'DELETE':
-            relation = get_object_or_404(
-                relation_model,
-                user=user,
-                recipe=recipe
-            )
-            relation.delete()
+            # Рецепт для удаления связи не загружается: одного DELETE
+            # достаточно, а число удалённых строк заменяет проверку
+            deleted, _ = relation_model.objects.filter(
+                user=user, recipe_id=recipe_id
+            ).delete()
+            if not deleted:
+                raise Http404
             return Response(status=HTTPStatus.NO_CONTENT)
 
-        if relation_model.objects.filter(user=user, recipe=recipe).exists():
+        recipe = get_object_or_404(
+            Recipe.objects.only('id', 'name', 'image', 'cooking_time'),
+            pk=recipe_id,
+        )
+
+        try:
+            with transaction.atomic():
+                relation_model.objects.create(user=user, recipe=recipe)
+        except IntegrityError:
             return Response(
                 {'error': error_message},
                 status=HTTPStatus.BAD_REQUEST
             )
 
-        relation_model.objects.create(user=user, recipe=recipe)
         recipe_data = serializers.ShortRecipeSerializer(recipe)
         return Response(recipe_data.data, status=HTTPStatus.CREATED)
 
+    def bulk_add_relations(self, request, relation_model):
+        """
+        Добавляет несколько рецептов в избранное или корзину за раз.
+
+        Все связи вставляются одним INSERT с пропуском уже существующих,
+        поэтому повторное добавление рецепта не считается ошибкой.
+        """
+        ids_serializer = serializers.RecipeIdsSerializer(data=request.data)
+        ids_serializer.is_valid(raise_exception=True)
+        recipe_ids = ids_serializer.validated_data['recipes']
+
+        recipes = list(
+            Recipe.objects.filter(pk__in=recipe_ids).only(
+                'id', 'name', 'image', 'cooking_time'
+            )
+        )
+        missing_ids = set(recipe_ids) - {recipe.id for recipe in recipes}
+        if missing_ids:
+            raise ValidationError(
+                {'recipes': f'Рецепты не найдены: {sorted(missing_ids)}'}
+            )
+
+        relation_model.objects.bulk_create(
+            (
+                relation_model(user=request.user, recipe=recipe)
+                for recipe in recipes
+            ),
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+        # bulk_create не шлёт сигналы, кэш списка покупок сбрасываем сами
+        if relation_model is ShoppingCart:
+            ShoppingCart.reset_cached_summary(request.user.pk)
+
+        return Response(
+            serializers.ShortRecipeSerializer(
+                recipes, many=True, context={'request': request}
+            ).data,
+            status=HTTPStatus.CREATED,
+        )
+
     @action(detail=True, methods=('POST', 'DELETE'))
     def favorite(self, request, pk):
         return self.manage_recipe_relation(
@@ -285,14 +422,31 @@ class RecipeViewSet(viewsets.ModelViewSet):
             relation_model=ShoppingCart,
         )
 
+    @action(
+        detail=False,
+        methods=('POST',),
+        permission_classes=(IsAuthenticated,),
+        url_path='favorite/bulk',
+    )
+    def favorite_bulk(self, request):
+        return self.bulk_add_relations(request, relation_model=Favorite)
+
+    @action(
+        detail=False,
+        methods=('POST',),
+        permission_classes=(IsAuthenticated,),
+        url_path='shopping_cart/bulk',
+    )
+    def shopping_cart_bulk(self, request):
+        return self.bulk_add_relations(request, relation_model=ShoppingCart)
+
 
 def recipe_shared_link(request, slug):
-    try:
-        recipe = Recipe.objects.get(short_url_code=slug)
-    except Recipe.DoesNotExist:
+    recipe_id = Recipe.get_id_by_short_code(slug)
+    if recipe_id is None:
         redirect_url = request.build_absolute_uri('/not_found')
     else:
         redirect_url = request.build_absolute_uri(
-            f'/recipes/{recipe.id}/'
+            f'/recipes/{recipe_id}/'
         )
     return HttpResponsePermanentRedirect(redirect_url)